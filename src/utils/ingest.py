@@ -1,9 +1,16 @@
 import os
+import time
 import hashlib
 import chromadb
+import chromadb.errors
+import httpx
 from pathlib import Path
+from importlib.metadata import version
+from itertools import batched
+from typing import Iterable, Iterator, List
 from langchain_chroma import Chroma
-from langchain_text_splitters import MarkdownHeaderTextSplitter, RecursiveCharacterTextSplitter
+from langchain_core.documents import Document
+from langchain_text_splitters import RecursiveCharacterTextSplitter
 
 from utils.llm import EmbeddingModel
 from docling.datamodel.base_models import InputFormat
@@ -13,34 +20,61 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+HASH_BLOCK_SIZE = 1024 * 1024
+# Bump whenever a change to the splitting logic changes the chunks it produces
+SPLITTER_VERSION = 1
+MAX_SECTION_SIZE = 4000
+SECTION_OVERLAP = 200
+TRANSIENT_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+TRANSIENT_CHROMA_ERRORS = (
+    chromadb.errors.RateLimitError,
+    chromadb.errors.InternalError,
+)
+NETWORK_ERRORS = (httpx.TransportError, ConnectionError, TimeoutError)
+HEADERS_TO_SPLIT_ON = [
+    ("#", "Header 1"),
+    ("##", "Header 2"),
+    ("###", "Header 3"),
+    ("####", "Header 4"),
+]
 
-def get_file_hash(file_path: Path) -> str:
+
+def get_file_hash(file_path: Path, block_size: int = HASH_BLOCK_SIZE) -> str:
     """
-    Generate an MD5 hash of a file's contents.
+    Generate an MD5 hash of a file's contents, reading it in fixed-size blocks.
     
     Args:
         file_path (Path): The path to the file.
+        block_size (int): The number of bytes to read at a time.
         
     Returns:
         str: The MD5 hash of the file.
     """
     hasher = hashlib.md5()
     with open(file_path, "rb") as f:
-        buf = f.read()
-        hasher.update(buf)
+        for block in iter(lambda: f.read(block_size), b""):
+            hasher.update(block)
     return hasher.hexdigest()
 
 
-def convert_docx_to_markdown(doc_path: Path) -> str:
+def convert_docx_to_markdown(doc_path: Path, markdown_path: Path) -> Path:
     """
-    Convert a DOCX document to a markdown string.
+    Convert a DOCX document to a markdown file on disk.
+
+    The converted markdown is cached at `markdown_path`, so a resumed run
+    for the same file hash skips the conversion entirely.
     
     Args:
         doc_path (Path): The path to the DOCX file.
+        markdown_path (Path): Where to write the markdown content.
     
     Returns:
-        str: The markdown content of the document.
+        Path: The path to the markdown file.
     """
+    if markdown_path.exists():
+        print(f"Using cached markdown: {markdown_path}")
+        return markdown_path
+
     print(f"Converting DOCX: {doc_path}")
     pipeline_options = PaginatedPipelineOptions()
     converter = DocumentConverter(
@@ -49,56 +83,387 @@ def convert_docx_to_markdown(doc_path: Path) -> str:
         }
     )
     result = converter.convert(doc_path)
-    document = result.document
-    return document.export_to_markdown()
+
+    # Write to a temporary file first so an interrupted run leaves no partial cache
+    markdown_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = markdown_path.with_suffix(".tmp")
+    tmp_path.write_text(result.document.export_to_markdown(), encoding="utf-8")
+    tmp_path.replace(markdown_path)
+    return markdown_path
+
+
+def _parse_header(line: str):
+    """Return the (level, metadata key, title) of a markdown header line, or None."""
+    stripped = line.strip()
+    # Check the longest separators first so "##" is not mistaken for "#"
+    for level, (sep, name) in reversed(list(enumerate(HEADERS_TO_SPLIT_ON))):
+        if stripped.startswith(sep) and (
+            len(stripped) == len(sep) or stripped[len(sep)] == " "
+        ):
+            return level, name, stripped[len(sep):].strip()
+    return None
 
 
-def split_markdown(markdown_text: str, file_hash: str):
+def _is_header_only(content: str) -> bool:
+    """Return whether a section contains nothing but header lines."""
+    return all(_parse_header(line) or not line.strip() for line in content.splitlines())
+
+
+def _iter_sections(markdown_lines: Iterable[str], max_section_size: int):
+    """
+    Yield (content, metadata) for each header section of the markdown.
+
+    A section that grows past `max_section_size` characters is cut with a
+    RecursiveCharacterTextSplitter while it is being read, so no more than
+    about one oversized chunk is ever buffered. Every piece of a cut section
+    starts with the section's header line.
     """
-    Split markdown into chunks and add file hash to metadata.
+    headers = {}
+    section_header = None
+    section: List[str] = []
+    section_size = 0
+    in_code_block = False
+
+    def metadata():
+        return {name: title for _, (name, title) in sorted(headers.items())}
+
+    def join(body, separator="\n"):
+        if not section_header:
+            return "\n".join(body)
+        return section_header + separator + "\n".join(body)
+
+    for line in markdown_lines:
+        line = line.rstrip("\n")
+        if line.strip().startswith(("```", "~~~")):
+            in_code_block = not in_code_block
+
+        header = None if in_code_block else _parse_header(line)
+        if header:
+            content = join(section).strip()
+            if content:
+                yield content, metadata()
+            section_header, section, section_size = line.strip(), [], len(line) + 2
+            level, name, title = header
+            # A new header closes every open header at the same or a deeper level
+            for open_level in [lvl for lvl in headers if lvl >= level]:
+                del headers[open_level]
+            headers[level] = (name, title)
+            continue
+
+        section.append(line)
+        section_size += len(line) + 1
+        if section_size > max_section_size:
+            # Split the body only, leaving room to repeat the header on each piece
+            header_size = len(section_header) + 2 if section_header else 0
+            chunk_size = max(max_section_size - header_size, 1)
+            text_splitter = RecursiveCharacterTextSplitter(
+                chunk_size=chunk_size,
+                chunk_overlap=min(SECTION_OVERLAP, chunk_size // 4),
+            )
+            # Emit all but the last piece and keep reading into the remainder
+            *pieces, remainder = text_splitter.split_text("\n".join(section)) or [""]
+            for piece in pieces:
+                yield join([piece], "\n\n"), metadata()
+            section, section_size = ["", remainder], header_size + len(remainder)
+
+    content = join(section).strip()
+    if content:
+        yield content, metadata()
+
+
+def split_markdown(
+    markdown_lines: Iterable[str],
+    file_hash: str,
+    max_section_size: int = MAX_SECTION_SIZE,
+) -> Iterator[Document]:
+    """
+    Incrementally split markdown into header sections and add file hash to metadata.
+
+    Lines are consumed one at a time and each section is yielded as soon as
+    the next header starts. Like MarkdownHeaderTextSplitter with
+    `strip_headers=False`, a section holding only a header is folded into
+    the deeper section that follows it. Unlike it, blank lines are kept, and
+    sections longer than `max_section_size` characters are split further.
     
     Args:
-        markdown_text (str): The markdown content to split.
+        markdown_lines (Iterable[str]): The markdown content, line by line.
         file_hash (str): The hash of the source file.
+        max_section_size (int): The maximum number of characters per chunk.
         
-    Returns:
-        List[Document]: A list of document chunks with metadata.
+    Yields:
+        Document: A document chunk with header and file hash metadata.
     """
     print("Splitting markdown into chunks...")
-    headers_to_split_on = [
-        ("#", "Header 1"),
-        ("##", "Header 2"),
-        ("###", "Header 3"),
-        ("####", "Header 4"),
-    ]
-    splitter = MarkdownHeaderTextSplitter(headers_to_split_on=headers_to_split_on, strip_headers=False)
-    splits = splitter.split_text(markdown_text)
-
-    if not splits:
-        print("Markdown splitter failed, using RecursiveCharacterTextSplitter.")
-        recursive = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-        splits = recursive.split_text(markdown_text)
+    # A header-only section waiting to be merged into the next, deeper section
+    pending = None
+
+    for content, metadata in _iter_sections(markdown_lines, max_section_size):
+        if pending:
+            pending_content, pending_metadata = pending
+            pending = None
+            if len(pending_metadata) < len(metadata):
+                content = f"{pending_content}\n\n{content}"
+            else:
+                yield Document(
+                    page_content=pending_content,
+                    metadata={**pending_metadata, "file_hash": file_hash},
+                )
+
+        if _is_header_only(content):
+            pending = (content, metadata)
+        else:
+            yield Document(
+                page_content=content, metadata={**metadata, "file_hash": file_hash}
+            )
+
+    if pending:
+        pending_content, pending_metadata = pending
+        yield Document(
+            page_content=pending_content,
+            metadata={**pending_metadata, "file_hash": file_hash},
+        )
+
+
+def get_chunking_version(max_section_size: int = MAX_SECTION_SIZE) -> str:
+    """
+    Fingerprint everything that decides how a file is split into chunks.
+
+    Chunk indices are only comparable between runs that share this version,
+    so it is part of every chunk id.
     
-    # Add the file hash to the metadata of each chunk
-    for doc in splits:
-        if doc.metadata is None:
-            doc.metadata = {}
-        doc.metadata["file_hash"] = file_hash
+    Args:
+        max_section_size (int): The maximum number of characters per chunk.
+        
+    Returns:
+        str: A short hash of the splitter version and settings.
+    """
+    settings = (
+        f"{SPLITTER_VERSION}:{max_section_size}:{SECTION_OVERLAP}:{version('docling')}"
+    )
+    return hashlib.md5(settings.encode()).hexdigest()[:8]
+
 
-    return splits
+def get_chunk_id(file_hash: str, chunking_version: str, index: int) -> str:
+    """Return the deterministic id of the chunk at `index` of a file."""
+    return f"{file_hash}-{chunking_version}-{index}"
 
 
-def ingest_to_chroma_cloud(markdown_chunks, collection_name: str, embedding_model, chroma_host: str, chroma_api_key: str, chroma_tenant: str, chroma_database: str, file_hash: str):
+def get_ingested_ids(
+    vector_store: Chroma, file_hash: str, page_size: int = 1000
+) -> set:
     """
-    Ingests document chunks into a Chroma Cloud collection only if the file hash has changed.
+    Collect the ids of chunks from this file that are already in the collection.
+
+    Chunk ids are deterministic, so these ids act as the checkpoint of a
+    previous run that failed partway through.
+    
+    Args:
+        vector_store (Chroma): The vector store wrapping the collection.
+        file_hash (str): The hash of the source file.
+        page_size (int): The number of ids to fetch per request.
+        
+    Returns:
+        set: The ids already stored for this file hash.
+    """
+    ingested = set()
+    offset = 0
+    while True:
+        results = vector_store.get(
+            where={"file_hash": file_hash}, include=[], limit=page_size, offset=offset
+        )
+        ingested.update(results["ids"])
+        if len(results["ids"]) < page_size:
+            return ingested
+        offset += page_size
+
+
+def is_transient_error(error: Exception) -> bool:
+    """
+    Return whether an embedding or upsert error is worth retrying.
+
+    Connection failures, timeouts, rate limits and server errors are
+    transient. Anything else, such as a bad API key or invalid metadata,
+    will fail again on every attempt.
     
     Args:
-        markdown_chunks (List[Document]): The document chunks to ingest.
+        error (Exception): The error raised by the embedding model or Chroma.
+        
+    Returns:
+        bool: True if the operation should be retried.
+    """
+    if isinstance(error, chromadb.errors.ChromaError):
+        return isinstance(error, TRANSIENT_CHROMA_ERRORS)
+    if type(error) is Exception:
+        # Chroma raises a bare Exception carrying only the response body for
+        # HTTP errors it does not recognise, such as a 502/503 from its gateway
+        return True
+    # Embedding clients (openai, ollama) attach the HTTP status to their errors
+    if getattr(error, "status_code", None) in TRANSIENT_STATUS_CODES:
+        # An exhausted OpenAI quota is reported as a rate limit but never recovers
+        return getattr(error, "code", None) != "insufficient_quota"
+    # Clients wrap the underlying network error, so check the whole chain
+    seen = set()
+    while error is not None and id(error) not in seen:
+        if isinstance(error, NETWORK_ERRORS):
+            return True
+        seen.add(id(error))
+        error = error.__cause__ or error.__context__
+    return False
+
+
+def upsert_with_retry(
+    vector_store: Chroma,
+    documents: List[Document],
+    ids: List[str],
+    max_retries: int,
+    backoff: float,
+):
+    """
+    Embed and upsert a batch of documents, retrying transient errors with backoff.
+    
+    Args:
+        vector_store (Chroma): The vector store to write to.
+        documents (List[Document]): The document chunks in this batch.
+        ids (List[str]): The ids of the document chunks.
+        max_retries (int): The number of attempts before giving up.
+        backoff (float): The delay in seconds before the first retry.
+    """
+    for attempt in range(1, max_retries + 1):
+        try:
+            vector_store.add_documents(documents=documents, ids=ids)
+            return
+        except Exception as e:
+            if attempt == max_retries or not is_transient_error(e):
+                raise
+            delay = backoff * 2 ** (attempt - 1)
+            print(
+                f"Batch upsert failed (attempt {attempt}/{max_retries}): {e}. "
+                f"Retrying in {delay:.1f}s..."
+            )
+            time.sleep(delay)
+
+
+def upsert_chunks(
+    vector_store: Chroma,
+    markdown_chunks: Iterable[Document],
+    file_hash: str,
+    chunking_version: str,
+    batch_size: int = 64,
+    max_retries: int = 5,
+    backoff: float = 2.0,
+):
+    """
+    Upsert document chunks in bounded batches, skipping chunks already stored.
+
+    Each chunk gets the id `<file_hash>-<chunking_version>-<index>`, so
+    chunks stored by an earlier, interrupted run for the same file and
+    chunking version are skipped and ingestion resumes where it stopped.
+    Chunks of this file stored with another chunking version come from a
+    different split and are deleted first. Content stored for this hash
+    only under ids without the hash prefix (by the earlier
+    `Chroma.from_documents` ingestion) counts as complete.
+    
+    Args:
+        vector_store (Chroma): The vector store to write to.
+        markdown_chunks (Iterable[Document]): The document chunks to ingest.
+        file_hash (str): The hash of the source file.
+        chunking_version (str): The version from `get_chunking_version`.
+        batch_size (int): The number of chunks to embed and upsert at a time.
+        max_retries (int): The number of attempts per batch.
+        backoff (float): The delay in seconds before the first retry of a batch.
+        
+    Returns:
+        int: The number of chunks upserted.
+    """
+    # Find chunks of this file that a previous run already stored
+    try:
+        ingested_ids = get_ingested_ids(vector_store, file_hash)
+    except Exception as e:
+        print(f"An error occurred while checking the collection: {e}")
+        # Proceed with a full ingestion if the check fails; upserts are idempotent
+        ingested_ids = set()
+
+    current_ids = {
+        i for i in ingested_ids if i.startswith(f"{file_hash}-{chunking_version}-")
+    }
+    outdated_ids = ingested_ids - current_ids
+    if outdated_ids and not any(i.startswith(f"{file_hash}-") for i in ingested_ids):
+        print(
+            "The collection already contains content with this hash "
+            "(stored under legacy ids). Skipping ingestion."
+        )
+        return 0
+    if outdated_ids:
+        print(
+            f"Deleting {len(outdated_ids)} chunks with this hash that were split "
+            "with different chunking settings..."
+        )
+        for batch in batched(sorted(outdated_ids), batch_size):
+            vector_store.delete(ids=list(batch))
+    if current_ids:
+        print(f"Found {len(current_ids)} chunks with this hash. Resuming.")
+    ingested_ids = current_ids
+
+    total = 0
+    upserted = 0
+    for batch in batched(enumerate(markdown_chunks), batch_size):
+        total += len(batch)
+        pending = [
+            (get_chunk_id(file_hash, chunking_version, index), chunk)
+            for index, chunk in batch
+            if get_chunk_id(file_hash, chunking_version, index) not in ingested_ids
+        ]
+        if not pending:
+            continue
+        ids = [chunk_id for chunk_id, _ in pending]
+        documents = [chunk for _, chunk in pending]
+        upsert_with_retry(vector_store, documents, ids, max_retries, backoff)
+        upserted += len(pending)
+        print(f"Upserted {upserted} chunks...")
+
+    if not total:
+        print("Warning: the document produced no chunks. Nothing was ingested.")
+    elif not upserted:
+        print(
+            "The collection already contains content with this hash. "
+            "Skipping ingestion."
+        )
+    return upserted
+
+
+def ingest_to_chroma_cloud(
+    markdown_chunks: Iterable[Document],
+    collection_name: str,
+    embedding_model,
+    chroma_host: str,
+    chroma_api_key: str,
+    chroma_tenant: str,
+    chroma_database: str,
+    file_hash: str,
+    chunking_version: str,
+    batch_size: int = 64,
+    max_retries: int = 5,
+    backoff: float = 2.0,
+):
+    """
+    Ingests document chunks into a Chroma Cloud collection in bounded batches.
+
+    Chunks already stored for this file hash are skipped, so an interrupted
+    run resumes where it stopped and a fully ingested file is a no-op.
+    
+    Args:
+        markdown_chunks (Iterable[Document]): The document chunks to ingest.
         collection_name (str): The name of the Chroma collection.
         embedding_model (EmbeddingFunction): The embedding model to use.
         chroma_host (str): The Chroma Cloud host address.
         chroma_api_key (str): The API key for authentication.
+        chroma_tenant (str): The Chroma Cloud tenant.
+        chroma_database (str): The Chroma Cloud database.
         file_hash (str): The hash of the source file.
+        chunking_version (str): The version from `get_chunking_version`.
+        batch_size (int): The number of chunks to embed and upsert at a time.
+        max_retries (int): The number of attempts per batch.
+        backoff (float): The delay in seconds before the first retry of a batch.
     """
     print(f"Connecting to Chroma Cloud at {chroma_host}...")
     chroma_client = chromadb.CloudClient(
@@ -106,29 +471,24 @@ def ingest_to_chroma_cloud(markdown_chunks, collection_name: str, embedding_mode
         tenant=chroma_tenant,
         database=chroma_database
     )
-
-    
-    # Check for an existing collection and the presence of the current file hash
-    try:
-        if collection_name in [c.name for c in chroma_client.list_collections()]:
-            collection = chroma_client.get_collection(name=collection_name)
-            # Use the where clause to find if any document has the current hash
-            results = collection.get(where={"file_hash": file_hash})
-            if results["ids"]:
-                print(f"Collection '{collection_name}' already contains content with this hash. Skipping ingestion.")
-                return
-    except Exception as e:
-        print(f"An error occurred while checking the collection: {e}")
-        # Proceed with ingestion if the check fails
+    vector_store = Chroma(
+        client=chroma_client,
+        collection_name=collection_name,
+        embedding_function=embedding_model
+    )
 
     print(f"Creating or updating collection '{collection_name}'...")
-    Chroma.from_documents(
-        documents=markdown_chunks,
-        embedding=embedding_model,
-        collection_name=collection_name,
-        client=chroma_client
+    upserted = upsert_chunks(
+        vector_store,
+        markdown_chunks,
+        file_hash,
+        chunking_version,
+        batch_size,
+        max_retries,
+        backoff,
     )
-    print("Successfully ingested data into Chroma Cloud.")
+    if upserted:
+        print("Successfully ingested data into Chroma Cloud.")
 
 
 if __name__ == "__main__":
@@ -138,6 +498,7 @@ if __name__ == "__main__":
     base_dir = Path(__file__).resolve().parent.parent.parent
     print(f"Base directory: {base_dir}")
     doc_path = base_dir / "data" / "personal_recipe.docx"
+    cache_dir = Path(os.getenv("INGEST_CACHE_DIR", base_dir / ".ingest_cache"))
 
     if not doc_path.exists():
         raise FileNotFoundError(f"File not found: {doc_path}")
@@ -148,6 +509,8 @@ if __name__ == "__main__":
     chroma_database = os.getenv("CHROMA_DATABASE", "default_database")
     chroma_api_key = os.getenv("CHROMA_API_KEY")
     collection_name = os.getenv("CHROMA_COLLECTION_NAME", "recipes")
+    batch_size = int(os.getenv("INGEST_BATCH_SIZE", "64"))
+    max_retries = int(os.getenv("INGEST_MAX_RETRIES", "5"))
 
     if not chroma_api_key:
         raise EnvironmentError("CHROMA_API_KEY must be set in your environment.")
@@ -156,18 +519,25 @@ if __name__ == "__main__":
     file_hash = get_file_hash(doc_path)
 
     # Start pipeline
-    markdown_text = convert_docx_to_markdown(doc_path)
-    markdown_chunks = split_markdown(markdown_text, file_hash)
+    markdown_path = convert_docx_to_markdown(
+        doc_path, cache_dir / f"{file_hash}-docling-{version('docling')}.md"
+    )
 
     embedding_model = EmbeddingModel().get_embedding_model()
 
-    ingest_to_chroma_cloud(
-        markdown_chunks,
-        collection_name,
-        embedding_model,
-        chroma_host,
-        chroma_api_key,
-        chroma_tenant,
-        chroma_database,
-        file_hash
-    )
+    with open(markdown_path, encoding="utf-8") as markdown_file:
+        markdown_chunks = split_markdown(markdown_file, file_hash)
+
+        ingest_to_chroma_cloud(
+            markdown_chunks,
+            collection_name,
+            embedding_model,
+            chroma_host,
+            chroma_api_key,
+            chroma_tenant,
+            chroma_database,
+            file_hash,
+            get_chunking_version(),
+            batch_size=batch_size,
+            max_retries=max_retries
+        )
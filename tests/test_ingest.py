@@ -0,0 +1,281 @@
+import io
+import uuid
+
+import chromadb
+import httpx
+import openai
+import pytest
+from chromadb.api.base_http_client import BaseHTTPClient
+from langchain_chroma import Chroma
+from langchain_core.documents import Document
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from utils import ingest
+from utils.ingest import (
+    get_chunk_id,
+    get_chunking_version,
+    get_file_hash,
+    is_transient_error,
+    split_markdown,
+    upsert_chunks,
+    upsert_with_retry,
+)
+
+FILE_HASH = "abc123"
+VERSION = "v2"
+
+
+def split(markdown, **kwargs):
+    return list(split_markdown(io.StringIO(markdown), FILE_HASH, **kwargs))
+
+
+@pytest.fixture
+def vector_store():
+    return Chroma(
+        client=chromadb.EphemeralClient(),
+        collection_name=f"test-{uuid.uuid4().hex}",
+        embedding_function=DeterministicFakeEmbedding(size=8),
+    )
+
+
+def stored_ids(vector_store):
+    return set(vector_store.get(include=[])["ids"])
+
+
+def test_get_file_hash_matches_across_block_sizes(tmp_path):
+    path = tmp_path / "recipe.docx"
+    path.write_bytes(b"mapo tofu" * 1000)
+
+    assert get_file_hash(path, block_size=7) == get_file_hash(path)
+
+
+def test_split_markdown_folds_header_only_parents_into_first_child():
+    docs = split(
+        "# Recipes\n\n## Pasta\n\n### Carbonara\n\nEggs and cheese.\n\nGuanciale.\n"
+    )
+
+    assert len(docs) == 1
+    assert docs[0].page_content == (
+        "# Recipes\n\n## Pasta\n\n### Carbonara\n\nEggs and cheese.\n\nGuanciale."
+    )
+    assert docs[0].metadata == {
+        "Header 1": "Recipes",
+        "Header 2": "Pasta",
+        "Header 3": "Carbonara",
+        "file_hash": FILE_HASH,
+    }
+
+
+def test_split_markdown_pops_back_to_shallower_header():
+    docs = split(
+        "# Recipes\n\n## Pasta\n\nBoil water.\n\n### Sauce\n\nTomato.\n\n"
+        "## Soup\n\nBroth.\n\n# Drinks\n\nTea.\n"
+    )
+
+    assert [doc.metadata for doc in docs] == [
+        {"Header 1": "Recipes", "Header 2": "Pasta", "file_hash": FILE_HASH},
+        {
+            "Header 1": "Recipes",
+            "Header 2": "Pasta",
+            "Header 3": "Sauce",
+            "file_hash": FILE_HASH,
+        },
+        {"Header 1": "Recipes", "Header 2": "Soup", "file_hash": FILE_HASH},
+        {"Header 1": "Drinks", "file_hash": FILE_HASH},
+    ]
+
+
+def test_split_markdown_keeps_trailing_header_only_section():
+    docs = split("## Soup\n\nBroth.\n\n# Empty\n")
+
+    assert [doc.page_content for doc in docs] == ["## Soup\n\nBroth.", "# Empty"]
+
+
+def test_split_markdown_ignores_headers_inside_code_fences():
+    docs = split("# Curry\n\n```\n# not a header\n```\n\nRice.\n")
+
+    assert len(docs) == 1
+    assert "# not a header" in docs[0].page_content
+    assert docs[0].metadata == {"Header 1": "Curry", "file_hash": FILE_HASH}
+
+
+def test_split_markdown_without_headers():
+    docs = split("Just some notes.\n\nNo headings here.\n")
+
+    assert len(docs) == 1
+    assert docs[0].page_content == "Just some notes.\n\nNo headings here."
+    assert docs[0].metadata == {"file_hash": FILE_HASH}
+
+
+def test_split_markdown_empty_input():
+    assert split("") == []
+
+
+def test_split_markdown_caps_section_size():
+    docs = split("# Stock\n\n" + "Simmer the bones.\n" * 500, max_section_size=200)
+
+    assert len(docs) > 1
+    assert all(len(doc.page_content) <= 200 for doc in docs)
+    assert all(doc.metadata["Header 1"] == "Stock" for doc in docs)
+    assert all(doc.page_content.startswith("# Stock\n\n") for doc in docs)
+
+
+def test_split_markdown_repeats_header_on_pieces_of_one_oversized_paragraph():
+    paragraph = "Simmer the bones for hours. " * 220
+    docs = split(f"# Stock\n\n{paragraph}\n", max_section_size=1000)
+
+    assert len(docs) > 1
+    assert all(len(doc.page_content) <= 1000 for doc in docs)
+    assert all(doc.page_content.startswith("# Stock\n\n") for doc in docs)
+    assert all("bones" in doc.page_content for doc in docs)
+
+
+def test_chunk_ids_are_stable_across_runs(vector_store):
+    markdown = "# Pasta\n\nBoil water.\n\n# Soup\n\nBroth.\n\n# Tea\n\nSteep.\n"
+
+    first = upsert_chunks(vector_store, split(markdown), FILE_HASH, VERSION, batch_size=2)
+    ids_after_first = stored_ids(vector_store)
+    second = upsert_chunks(vector_store, split(markdown), FILE_HASH, VERSION, batch_size=2)
+
+    assert first == 3
+    assert second == 0
+    assert ids_after_first == {get_chunk_id(FILE_HASH, VERSION, i) for i in range(3)}
+    assert stored_ids(vector_store) == ids_after_first
+
+
+def test_upsert_chunks_resumes_only_missing_chunks(vector_store):
+    chunks = split("".join(f"# Recipe {i}\n\nStep {i}.\n\n" for i in range(5)))
+    vector_store.add_documents(
+        documents=chunks[:2], ids=[get_chunk_id(FILE_HASH, VERSION, i) for i in range(2)]
+    )
+
+    upserted = []
+    original_add = vector_store.add_documents
+
+    def recording_add(documents, ids):
+        upserted.extend(ids)
+        return original_add(documents=documents, ids=ids)
+
+    vector_store.add_documents = recording_add
+    assert upsert_chunks(vector_store, chunks, FILE_HASH, VERSION, batch_size=2) == 3
+
+    assert upserted == [get_chunk_id(FILE_HASH, VERSION, i) for i in range(2, 5)]
+    assert stored_ids(vector_store) == {get_chunk_id(FILE_HASH, VERSION, i) for i in range(5)}
+
+
+def test_upsert_chunks_replaces_chunks_from_another_chunking_version(vector_store):
+    old_chunks = split("# Pasta\n\nBoil water.\n\n# Soup\n\nBroth.\n")
+    vector_store.add_documents(
+        documents=old_chunks,
+        ids=[get_chunk_id(FILE_HASH, "v1", i) for i in range(2)],
+    )
+    new_chunks = split("# Pasta\n\nBoil water.\n\n# Soup\n\nBroth.\n\n# Tea\n\nSteep.\n")
+
+    assert upsert_chunks(vector_store, new_chunks, FILE_HASH, VERSION) == 3
+    assert stored_ids(vector_store) == {get_chunk_id(FILE_HASH, VERSION, i) for i in range(3)}
+
+
+def test_get_chunking_version_depends_on_section_size():
+    assert get_chunking_version() == get_chunking_version()
+    assert get_chunking_version(1000) != get_chunking_version(2000)
+
+
+def test_upsert_chunks_skips_content_stored_under_legacy_ids(vector_store):
+    chunks = split("# Pasta\n\nBoil water.\n\n# Soup\n\nBroth.\n")
+    vector_store.add_documents(documents=chunks, ids=["legacy-1", "legacy-2"])
+
+    assert upsert_chunks(vector_store, chunks, FILE_HASH, VERSION) == 0
+    assert stored_ids(vector_store) == {"legacy-1", "legacy-2"}
+
+
+def test_upsert_chunks_warns_when_no_chunks_are_produced(vector_store, capsys):
+    assert upsert_chunks(vector_store, [], FILE_HASH, VERSION) == 0
+    assert "produced no chunks" in capsys.readouterr().out
+
+
+def chroma_error(status_code, body):
+    """Return the error chromadb's HTTP client raises for a response."""
+    request = httpx.Request("POST", "https://api.trychroma.com")
+    response = httpx.Response(status_code, text=body, request=request)
+    try:
+        BaseHTTPClient._raise_chroma_error(response)
+    except Exception as e:
+        return e
+
+
+def openai_error(transport):
+    """Return the error the OpenAI client raises when embedding over a transport."""
+    client = openai.OpenAI(
+        api_key="test",
+        max_retries=0,
+        http_client=httpx.Client(transport=httpx.MockTransport(transport)),
+    )
+    try:
+        client.embeddings.create(model="text-embedding-3-small", input="tofu")
+    except Exception as e:
+        return e
+
+
+def openai_status_error(status_code, code="error"):
+    body = {"error": {"message": "failed", "type": code, "code": code}}
+    return openai_error(lambda request: httpx.Response(status_code, json=body))
+
+
+def refuse_connection(request):
+    raise httpx.ConnectError("connection refused", request=request)
+
+
+def test_is_transient_error_for_chroma_errors():
+    assert is_transient_error(chroma_error(502, "<html>Bad Gateway</html>"))
+    assert is_transient_error(chroma_error(503, "Service Unavailable"))
+    assert is_transient_error(
+        chroma_error(429, '{"error": "RateLimitError", "message": "slow down"}')
+    )
+    assert not is_transient_error(
+        chroma_error(401, '{"error": "AuthorizationError", "message": "bad key"}')
+    )
+    assert not is_transient_error(
+        chroma_error(400, '{"error": "InvalidArgumentError", "message": "bad"}')
+    )
+
+
+def test_is_transient_error_for_embedding_errors():
+    assert is_transient_error(openai_error(refuse_connection))
+    assert is_transient_error(openai_status_error(429, "rate_limit_exceeded"))
+    assert is_transient_error(openai_status_error(500))
+    assert not is_transient_error(openai_status_error(429, "insufficient_quota"))
+    assert not is_transient_error(openai_status_error(401, "invalid_api_key"))
+    assert not is_transient_error(ValueError("invalid metadata"))
+
+
+def test_upsert_with_retry_retries_transient_errors(monkeypatch):
+    monkeypatch.setattr(ingest.time, "sleep", lambda _: None)
+    attempts = []
+
+    class FlakyStore:
+        def add_documents(self, documents, ids):
+            attempts.append(ids)
+            if len(attempts) < 3:
+                raise chroma_error(503, "<html>Service Unavailable</html>")
+
+    docs = [Document(page_content="Broth.")]
+    upsert_with_retry(FlakyStore(), docs, ["id-0"], max_retries=5, backoff=1.0)
+
+    assert len(attempts) == 3
+
+
+def test_upsert_with_retry_raises_permanent_errors_immediately(monkeypatch):
+    monkeypatch.setattr(ingest.time, "sleep", lambda _: None)
+    attempts = []
+
+    class BrokenStore:
+        def add_documents(self, documents, ids):
+            attempts.append(ids)
+            raise chroma_error(
+                401, '{"error": "AuthorizationError", "message": "bad key"}'
+            )
+
+    docs = [Document(page_content="Broth.")]
+    with pytest.raises(chromadb.errors.AuthorizationError):
+        upsert_with_retry(BrokenStore(), docs, ["id-0"], max_retries=5, backoff=1.0)
+
+    assert len(attempts) == 1